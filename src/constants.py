@@ -5,10 +5,15 @@ Constants for P2P-CI system
 # Network
 SERVER_PORT = 7734
 BUFFER_SIZE = 4096
+RECV_CHUNK = 64 * 1024  # read size for P2S responses, which can carry thousands of records
+SOCKET_BUFFER_SIZE = 1 << 20  # SO_SNDBUF / SO_RCVBUF for peer and server sockets
 
 # Protocol
 PROTOCOL_VERSION = "P2P-CI/1.0"
 CRLF = "\r\n"
+# Wire forms of the above, for code that works on raw socket bytes
+PROTOCOL_VERSION_BYTES = PROTOCOL_VERSION.encode("ascii")
+CRLF_BYTES = CRLF.encode("ascii")
 
 # Status Codes
 STATUS_OK = 200
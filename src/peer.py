@@ -1,19 +1,23 @@
 import argparse
+import asyncio
+import json
 import os
 import platform
+import re
 import socket
 import threading
-from datetime import datetime, timezone
+import time
 
 from src.constants import (
     SERVER_PORT,
-    BUFFER_SIZE,
+    SOCKET_BUFFER_SIZE,
     CRLF,
     PROTOCOL_VERSION,
     STATUS_OK,
     STATUS_NOT_FOUND,
     STATUS_BAD_REQUEST,
     STATUS_VERSION_NOT_SUPPORTED,
+    STATUS_PHRASES,
     HEADER_DATE,
     HEADER_OS,
     HEADER_LAST_MODIFIED,
@@ -23,16 +27,53 @@ from src.constants import (
     METHOD_LOOKUP,
     METHOD_LIST,
 )
-from src.protocol import parse_p2p_request, format_p2p_response, format_p2s_request, parse_p2s_response
-from src.socket_utils import recv_until_marker, recv_p2s_response
+from src.protocol import parse_p2p_request, format_p2p_response_parts, format_p2s_request, parse_p2s_response
+from src.socket_utils import (
+    configure_socket, recv_until_marker, recv_p2s_response, recv_p2s_responses, send_message
+)
+
+
+# platform.platform() reads /etc/os-release and uname each call; it never changes
+_PLATFORM = platform.platform()
+
+# Per-directory memo of RFC titles, see find_local_rfcs
+TITLE_CACHE_FILE = ".titles.json"
+
+_RFC_FILE_RE = re.compile(r"rfc([0-9]+)\.txt", re.IGNORECASE)
+
+# Seconds an upload connection may take to send its GET before it is dropped
+UPLOAD_REQUEST_TIMEOUT = 10
+# Seconds UploadServer.stop() waits for the upload thread to finish
+UPLOAD_STOP_TIMEOUT = 5
+
+_OK_STATUS_LINE = f"{PROTOCOL_VERSION} {STATUS_OK} {STATUS_PHRASES[STATUS_OK]}{CRLF}".encode("utf-8")
+
+# Fixed English names, so the Date header does not depend on the C locale
+_WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+# (whole second, formatted Date) for the current time; the header has 1 s resolution
+_now_date = (None, "")
+
+
+def _format_http_date(ts) -> str:
+    t = time.gmtime(ts)
+    return (
+        f"{_WEEKDAYS[t.tm_wday]}, {t.tm_mday:02d} {_MONTHS[t.tm_mon - 1]} {t.tm_year} "
+        f"{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d} GMT"
+    )
 
 
 def http_date(ts=None) -> str:
-    if ts is None:
-        dt = datetime.now(timezone.utc)
-    else:
-        dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-    return dt.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    global _now_date
+    if ts is not None:
+        return _format_http_date(ts)
+    now = int(time.time())
+    cached_sec, cached = _now_date
+    if now != cached_sec:
+        cached = _format_http_date(now)
+        _now_date = (now, cached)
+    return cached
 
 
 def read_p2s_response(sock: socket.socket) -> str:
@@ -40,159 +81,305 @@ def read_p2s_response(sock: socket.socket) -> str:
     return buf.decode("utf-8", errors="replace")
 
 
+def _read_title(path: str, rfc_number: int) -> str:
+    """First non-empty line of an RFC file, or a fallback."""
+    title = f"RFC {rfc_number}"
+    try:
+        # Binary mode skips setting up a text decoder for the whole file;
+        # one buffered read covers the leading lines of any real RFC
+        with open(path, "rb") as f:
+            for line in f:
+                line = line.decode("utf-8", errors="ignore").strip()
+                if line:
+                    title = line[:80]
+                    break
+    except Exception:
+        pass
+    return title
+
+
+def _load_title_cache(cache_path: str) -> dict:
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _save_title_cache(cache_path: str, cache: dict):
+    tmp_path = cache_path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass  # read-only peer dir: just rescan next time
+
+
 def find_local_rfcs(peer_dir: str):
     """
     Looks for files named like rfc123.txt (case-insensitive).
     Returns list of (rfc_number, title, filepath).
     Title is either the first non-empty line or a fallback.
+
+    Titles are memoized in peer_dir/.titles.json by file name, mtime and
+    size, so files that have not changed are not reopened on later scans.
     """
     rfcs = []
     if not os.path.isdir(peer_dir):
         return rfcs
 
-    for name in os.listdir(peer_dir):
-        lower = name.lower()
-        if not (lower.startswith("rfc") and lower.endswith(".txt")):
-            continue
-        num_part = lower[3:-4]
-        if not num_part.isdigit():
-            continue
-        rfc_number = int(num_part)
-        path = os.path.join(peer_dir, name)
-
-        title = f"RFC {rfc_number}"
-        try:
-            with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                for line in f:
-                    line = line.strip()
-                    if line:
-                        title = line[:80]
-                        break
-        except Exception:
-            pass
+    cache_path = os.path.join(peer_dir, TITLE_CACHE_FILE)
+    cache = _load_title_cache(cache_path)
+    seen = {}
+
+    with os.scandir(peer_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            m = _RFC_FILE_RE.fullmatch(name)
+            # is_file() comes from the directory entry's type; only a symlink
+            # costs a stat, to see what it points at (symlinked RFCs are kept)
+            if m is None or not entry.is_file():
+                continue
+            rfc_number = int(m.group(1))
+
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            cached = cache.get(name)
+            if isinstance(cached, list) and len(cached) == 3 and cached[:2] == [st.st_mtime_ns, st.st_size]:
+                title = cached[2]
+            else:
+                title = _read_title(entry.path, rfc_number)
+            seen[name] = [st.st_mtime_ns, st.st_size, title]
+
+            rfcs.append((rfc_number, title, entry.path))
 
-        rfcs.append((rfc_number, title, path))
+    if seen != cache:
+        _save_title_cache(cache_path, seen)
 
     return sorted(rfcs, key=lambda x: x[0])
 
 
+def _set_cork(sock: socket.socket, on: bool):
+    """Toggle TCP_CORK where the platform has it (Linux); no-op elsewhere."""
+    if hasattr(socket, "TCP_CORK"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if on else 0)
+
+
 class UploadServer:
+    """
+    Serves this peer's RFC files to other peers.
+
+    Runs an asyncio event loop in a background thread: every upload
+    connection is a coroutine on that one loop rather than its own thread,
+    and file bodies go out through loop.sendfile().
+    """
+
     def __init__(self, peer_dir: str):
         self.peer_dir = peer_dir
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Set before listen() so accepted sockets start with the large buffers
+        configure_socket(self.sock)
         self.sock.bind(("0.0.0.0", 0))
         self.sock.listen()
         self.port = self.sock.getsockname()[1]
-        self.running = True
+        # rfc_number -> ((st_mtime_ns, st_size), encoded headers that follow Date)
+        self._header_cache = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._writers = set()  # open upload connections, touched only on the loop
 
     def start(self):
-        t = threading.Thread(target=self._loop, daemon=True)
-        t.start()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
 
     def stop(self):
-        self.running = False
+        if self._loop is not None and self._server is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._shutdown)
+            except RuntimeError:
+                pass  # loop already closed
+            self._thread.join(UPLOAD_STOP_TIMEOUT)
         try:
             self.sock.close()
         except Exception:
             pass
 
-    def _loop(self):
-        print(f"[peer] upload server listening on port {self.port}")
-        while self.running:
+    def _ok_header(self, rfc_number: int, st: os.stat_result) -> bytes:
+        """
+        Header block of a 200 response serving an RFC file.
+
+        Everything after Date depends only on the file, so it is formatted
+        once per file version and reused; only Date is filled in per request.
+        """
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = self._header_cache.get(rfc_number)
+        if cached is None or cached[0] != stamp:
+            headers = {
+                HEADER_OS: _PLATFORM,
+                HEADER_LAST_MODIFIED: http_date(st.st_mtime),
+                HEADER_CONTENT_LENGTH: str(st.st_size),
+                HEADER_CONTENT_TYPE: "text/plain",
+            }
+            tail = "".join(f"{k}: {v}{CRLF}" for k, v in headers.items()) + CRLF
+            cached = (stamp, tail.encode("utf-8"))
+            self._header_cache[rfc_number] = cached
+
+        date = f"{HEADER_DATE}: {http_date()}{CRLF}".encode("utf-8")
+        return b"".join([_OK_STATUS_LINE, date, cached[1]])
+
+    def _shutdown(self):
+        """
+        Stop accepting and drop every open upload connection; runs on the loop.
+
+        serve_forever() waits for live connections once the server is closed
+        (Python 3.12+), so an idle or slow peer would otherwise hold stop().
+        """
+        self._server.close()
+        for writer in list(self._writers):
+            writer.transport.abort()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._serve())
+        except asyncio.CancelledError:
+            pass  # serve_forever() is cancelled by stop()
+        finally:
             try:
-                conn, addr = self.sock.accept()
-            except OSError:
-                break
-            threading.Thread(target=self._handle, args=(conn, addr), daemon=True).start()
+                # Let handlers still unwinding finish before the loop goes away
+                pending = asyncio.all_tasks(self._loop)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+                self._loop.run_until_complete(self._loop.shutdown_default_executor())
+            finally:
+                self._loop.close()
+
+    async def _serve(self):
+        try:
+            self._server = await asyncio.start_server(self._handle, sock=self.sock)
+        finally:
+            self._ready.set()
+        print(f"[peer] upload server listening on port {self.port}")
+        await self._server.serve_forever()
 
-    def _handle(self, conn: socket.socket, addr):
-        ip, port = addr
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        ip, port = writer.get_extra_info("peername")[:2]
         print(f"[peer][upload] connection from {ip}:{port}")
+        conn = writer.get_extra_info("socket")
+        self._writers.add(writer)
 
         try:
-            raw = recv_until_marker(conn, b"\r\n\r\n")
-            if raw is None:
+            configure_socket(conn)
+            try:
+                raw = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), UPLOAD_REQUEST_TIMEOUT)
+            except asyncio.IncompleteReadError:
                 print("[peer][upload] connection closed before request (no data)")
                 return
+            except asyncio.TimeoutError:
+                print(f"[peer][upload] no request from {ip}:{port} within {UPLOAD_REQUEST_TIMEOUT}s")
+                return
 
             req = parse_p2p_request(raw)
             if req is None:
                 print("[peer][upload] 400 Bad Request (failed to parse)")
-                conn.sendall(format_p2p_response(STATUS_BAD_REQUEST, headers={"Content-Length": "0"}, data=b""))
+                writer.writelines(format_p2p_response_parts(STATUS_BAD_REQUEST, headers={"Content-Length": "0"}))
+                await writer.drain()
                 return
 
-            if req["version"] != PROTOCOL_VERSION:
-                print(f"[peer][upload] 505 Version Not Supported: {req['version']}")
-                conn.sendall(
-                    format_p2p_response(STATUS_VERSION_NOT_SUPPORTED, headers={"Content-Length": "0"}, data=b"")
+            if req.version != PROTOCOL_VERSION:
+                print(f"[peer][upload] 505 Version Not Supported: {req.version}")
+                writer.writelines(
+                    format_p2p_response_parts(STATUS_VERSION_NOT_SUPPORTED, headers={"Content-Length": "0"})
                 )
+                await writer.drain()
                 return
 
-            rfc_number = req["rfc_number"]
-            requester_host = req.get("host", "?")
-            requester_os = req.get("os", "?")
-            print(f"[peer][upload] GET RFC {rfc_number} from {requester_host} (OS: {requester_os})")
+            rfc_number = req.rfc_number
+            print(f"[peer][upload] GET RFC {rfc_number} from {req.host} (OS: {req.os})")
 
             path = os.path.join(self.peer_dir, f"rfc{rfc_number}.txt")
-            if not os.path.exists(path):
+            loop = asyncio.get_running_loop()
+            try:
+                # open() can block on a slow disk; keep it off the event loop
+                f = await loop.run_in_executor(None, open, path, "rb")
+            except OSError:
                 print(f"[peer][upload] 404 Not Found: rfc{rfc_number}.txt")
-                conn.sendall(format_p2p_response(STATUS_NOT_FOUND, headers={"Content-Length": "0"}, data=b""))
+                writer.writelines(format_p2p_response_parts(STATUS_NOT_FOUND, headers={"Content-Length": "0"}))
+                await writer.drain()
                 return
 
-            with open(path, "rb") as f:
-                data = f.read()
-
-            st = os.stat(path)
-            headers = {
-                HEADER_DATE: http_date(),
-                HEADER_OS: platform.platform(),
-                HEADER_LAST_MODIFIED: http_date(st.st_mtime),
-                HEADER_CONTENT_LENGTH: str(len(data)),
-                HEADER_CONTENT_TYPE: "text/plain",
-            }
-
-            print(f"[peer][upload] 200 OK: uploading RFC {rfc_number} ({len(data)} bytes)")
-            conn.sendall(format_p2p_response(STATUS_OK, headers=headers, data=data))
+            with f:
+                st = os.fstat(f.fileno())
+                header = self._ok_header(rfc_number, st)
+
+                print(f"[peer][upload] 200 OK: uploading RFC {rfc_number} ({st.st_size} bytes)")
+                # Cork so the header and the first file bytes leave as one segment;
+                # loop.sendfile() hands the file to the kernel without copying it through Python
+                _set_cork(conn, True)
+                try:
+                    writer.write(header)
+                    await loop.sendfile(writer.transport, f)
+                finally:
+                    _set_cork(conn, False)
             print(f"[peer][upload] finished uploading RFC {rfc_number} to {ip}:{port}")
 
+        except (ConnectionError, asyncio.LimitOverrunError) as e:
+            print(f"[peer][upload] connection error {ip}:{port}: {e}")
         finally:
+            self._writers.discard(writer)
+            writer.close()
             try:
-                conn.close()
+                await writer.wait_closed()
             except Exception:
                 pass
             print(f"[peer][upload] connection closed {ip}:{port}")
 
 
+def download_rfc(from_host: str, from_port: int, rfc_number: int, save_path: str) -> tuple[bool, int]:
+    """
+    GET an RFC from another peer and write it to save_path.
 
-def download_rfc(from_host: str, from_port: int, rfc_number: int, save_path: str) -> tuple[bool, bytes]:
-    s = socket.create_connection((from_host, from_port), timeout=10)
+    Returns (ok, number of body bytes received). If the sender closes
+    before the full Content-Length arrives, ok is False and save_path is
+    left as it was.
+    """
+    s = configure_socket(socket.create_connection((from_host, from_port), timeout=10))
     try:
         req = (
             f"GET RFC {rfc_number} {PROTOCOL_VERSION}{CRLF}"
             f"Host: {from_host}{CRLF}"
-            f"OS: {platform.platform()}{CRLF}"
+            f"OS: {_PLATFORM}{CRLF}"
             f"{CRLF}"
         )
         s.sendall(req.encode("utf-8"))
 
         buf = recv_until_marker(s, b"\r\n\r\n")
-        if buf is None or b"\r\n\r\n" not in buf:
-            return False, b""
+        head_end = -1 if buf is None else buf.find(b"\r\n\r\n")
+        if head_end < 0:
+            return False, 0
 
-        header_bytes, rest = buf.split(b"\r\n\r\n", 1)
-        header_text = header_bytes.decode("utf-8", errors="replace")
-        header_lines = header_text.split(CRLF)
+        with memoryview(buf)[:head_end] as header_bytes:
+            header_lines = str(header_bytes, "utf-8", "replace").split(CRLF)
 
         status_parts = header_lines[0].split()
         if len(status_parts) < 2:
-            return False, b""
+            return False, 0
         try:
             status_code = int(status_parts[1])
         except ValueError:
-            return False, b""
+            return False, 0
         if status_code != 200:
-            return False, b""
+            return False, 0
 
         headers = {}
         for line in header_lines[1:]:
@@ -201,18 +388,37 @@ def download_rfc(from_host: str, from_port: int, rfc_number: int, save_path: str
                 headers[k.strip()] = v.strip()
 
         length = int(headers.get("Content-Length", "0"))
-        data = rest
-        while len(data) < length:
-            chunk = s.recv(BUFFER_SIZE)
-            if not chunk:
-                break
-            data += chunk
-
-        data = data[:length]
-        with open(save_path, "wb") as f:
-            f.write(data)
 
-        return True, data
+        # Stream the body to disk as it arrives, through one reused buffer,
+        # so memory stays bounded however large the RFC is. It goes to a
+        # temp file first: a transfer cut off mid-body must not leave a
+        # short rfcN.txt behind to be registered on the next start
+        tmp_path = save_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                # Body bytes that arrived with the header
+                with memoryview(buf)[head_end + 4 : head_end + 4 + length] as rest:
+                    f.write(rest)
+                    received = len(rest)
+
+                if received < length:
+                    with memoryview(bytearray(min(length - received, SOCKET_BUFFER_SIZE))) as chunk:
+                        while received < length:
+                            n = s.recv_into(chunk, min(len(chunk), length - received))
+                            if not n:
+                                break  # connection closed early
+                            f.write(chunk[:n])
+                            received += n
+
+            if received < length:
+                return False, received
+            os.replace(tmp_path, save_path)
+            return True, received
+        finally:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass  # already moved into place
     finally:
         s.close()
 
@@ -230,7 +436,7 @@ def main():
     upload.start()
 
     # Connect to central server
-    server_sock = socket.create_connection((args.server_host, SERVER_PORT))
+    server_sock = configure_socket(socket.create_connection((args.server_host, SERVER_PORT)))
     print(f"[peer] connected to server {args.server_host}:{SERVER_PORT}")
 
     my_host = args.hostname
@@ -240,18 +446,21 @@ def main():
     local = find_local_rfcs(args.peer_dir)
     if local:
         print("[peer] registering local RFCs with server...")
+    reqs = []
     for rfc_number, title, _path in local:
         print(f"[peer] registering RFC {rfc_number}: {title}")
-        req = format_p2s_request("ADD", rfc_number, my_host, my_port, title)
-        server_sock.sendall(req.encode("utf-8"))
-        resp = read_p2s_response(server_sock)
-        print(resp.strip())
+        reqs.append(format_p2s_request("ADD", rfc_number, my_host, my_port, title))
+    # Pipeline every ADD, then read the answers in order
+    send_message(server_sock, reqs)
+    for resp in recv_p2s_responses(server_sock, len(reqs)):
+        print(resp.decode("utf-8", errors="replace").strip())
 
     # Simple CLI
     print("\nCommands:")
     print("  list")
     print("  lookup <rfc>")
     print("  get <rfc>")
+    print("  batch <file>   (list/lookup lines, sent pipelined)")
     print("  quit\n")
 
     try:
@@ -264,7 +473,7 @@ def main():
 
             if cmd == "list":
                 req = format_p2s_request(METHOD_LIST, "ALL", my_host, my_port, "")
-                server_sock.sendall(req.encode("utf-8"))
+                server_sock.sendall(req)
                 resp = read_p2s_response(server_sock)
                 # Print response, removing only trailing whitespace to preserve status line
                 print(resp.rstrip())
@@ -277,7 +486,7 @@ def main():
                     continue
                 rfc = int(parts[1])
                 req = format_p2s_request(METHOD_LOOKUP, rfc, my_host, my_port, f"RFC {rfc}")
-                server_sock.sendall(req.encode("utf-8"))
+                server_sock.sendall(req)
                 resp = read_p2s_response(server_sock)
                 # Print response, removing only trailing whitespace to preserve status line
                 print(resp.rstrip())
@@ -291,7 +500,7 @@ def main():
                 rfc = int(parts[1])
 
                 req = format_p2s_request(METHOD_LOOKUP, rfc, my_host, my_port, f"RFC {rfc}")
-                server_sock.sendall(req.encode("utf-8"))
+                server_sock.sendall(req)
                 resp = read_p2s_response(server_sock)
                 status, records = parse_p2s_response(resp)
 
@@ -314,7 +523,7 @@ def main():
                 host, port = chosen
                 save_path = os.path.join(args.peer_dir, f"rfc{rfc}.txt")
                 print(f"[peer] downloading RFC {rfc} from {host}:{port} ...")
-                ok, _data = download_rfc(host, port, rfc, save_path)
+                ok, _size = download_rfc(host, port, rfc, save_path)
 
                 if not ok:
                     print("[peer] download failed")
@@ -323,12 +532,44 @@ def main():
                 print(f"[peer] saved to {save_path}")
 
                 req = format_p2s_request(METHOD_ADD, rfc, my_host, my_port, chosen_title or f"RFC {rfc}")
-                server_sock.sendall(req.encode("utf-8"))
+                server_sock.sendall(req)
                 resp2 = read_p2s_response(server_sock)
                 print(resp2.strip())
                 continue
 
-            print("Unknown command. Try: list | lookup <rfc> | get <rfc> | quit")
+            if cmd.startswith("batch "):
+                path = cmd[len("batch ") :].strip()
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        lines = f.read().splitlines()
+                except OSError as e:
+                    print(f"[peer] cannot read batch file: {e}")
+                    continue
+
+                reqs = []
+                for line in lines:
+                    parts = line.split()
+                    if not parts:
+                        continue
+                    if parts == ["list"]:
+                        reqs.append(format_p2s_request(METHOD_LIST, "ALL", my_host, my_port, ""))
+                    elif len(parts) == 2 and parts[0] == "lookup" and parts[1].isdigit():
+                        rfc = int(parts[1])
+                        reqs.append(
+                            format_p2s_request(METHOD_LOOKUP, rfc, my_host, my_port, f"RFC {rfc}")
+                        )
+                    else:
+                        print(f"[peer] batch: skipping unsupported line: {line}")
+                if not reqs:
+                    continue
+
+                # One write for every request, then read the answers as they stream back
+                send_message(server_sock, reqs)
+                for resp in recv_p2s_responses(server_sock, len(reqs)):
+                    print(resp.decode("utf-8", errors="replace").rstrip())
+                continue
+
+            print("Unknown command. Try: list | lookup <rfc> | get <rfc> | batch <file> | quit")
 
     finally:
         try:
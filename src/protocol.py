@@ -2,52 +2,107 @@
 Protocol parsing and formatting for P2P-CI
 """
 
+import re
+from typing import NamedTuple
+
 from src.constants import (
-    CRLF, PROTOCOL_VERSION, STATUS_PHRASES,
+    CRLF, CRLF_BYTES, PROTOCOL_VERSION, STATUS_PHRASES,
     HEADER_HOST, HEADER_PORT, HEADER_TITLE, HEADER_OS,
     METHOD_ADD, METHOD_LOOKUP, METHOD_LIST, METHOD_GET,
     RFC_ALL, KEYWORD_RFC
 )
 
 
+# Encoded "<version> <code> <phrase>" + blank line for every known status
+_P2S_STATUS_HEADS = {
+    code: f"{PROTOCOL_VERSION} {code} {phrase}{CRLF}{CRLF}".encode("utf-8")
+    for code, phrase in STATUS_PHRASES.items()
+}
+
+# A P2S request exactly as format_p2s_request lays it out
+_P2S_REQUEST_RE = re.compile(
+    rb"(?:(ADD|LOOKUP|LIST) RFC ([0-9]+)|(LIST) ALL) (\S+)\r\n"
+    rb"Host: ([^\r\n]*)\r\n"
+    rb"Port: ([0-9]+)\r\n"
+    rb"(?:Title: ([^\r\n]*)\r\n)?"
+    rb"\r\n"
+)
+
+# Request-line tokens the regex can capture, mapped to the shared method constants
+_P2S_METHODS = {m.encode("ascii"): m for m in (METHOD_ADD, METHOD_LOOKUP, METHOD_LIST)}
+
+# A P2P GET exactly as download_rfc lays it out
+_P2P_REQUEST_RE = re.compile(
+    rb"GET RFC ([0-9]+) (\S+)\r\n"
+    rb"Host: ([^\r\n]*)\r\n"
+    rb"OS: ([^\r\n]*)\r\n"
+    rb"\r\n"
+)
+
+
+class P2SRequest(NamedTuple):
+    """A parsed ADD / LOOKUP / LIST request."""
+    method: str
+    rfc_number: int | str  # RFC_ALL for LIST
+    version: str
+    host: str
+    port: int
+    title: str = ""
+
+
+class P2PRequest(NamedTuple):
+    """A parsed GET request from another peer."""
+    method: str
+    rfc_number: int
+    version: str
+    host: str
+    os: str
+
+
 def _split_message(text: str):
     """
     Split message into (request/status line, headers dict).
 
-    Expects headers end with an empty line.
+    Expects headers end with an empty line. Only the header block is split
+    into lines; anything after the blank line is never touched.
     """
     # Don't use .strip() here aggressively because it can eat trailing CRLFCRLF.
+    end = text.find(CRLF + CRLF)
+    if end >= 0:
+        text = text[:end]
     lines = text.split(CRLF)
 
-    if not lines or not lines[0].strip():
+    first = lines[0].strip()
+    if not first:
         return None, None
 
-    first = lines[0].strip()
     headers = {}
 
     # Header lines until empty line
     for line in lines[1:]:
         if line == "":
             break
-        if ":" not in line:
+        k, sep, v = line.partition(":")
+        if not sep:
             return None, None
-        k, v = line.split(":", 1)
         headers[k.strip()] = v.strip()
 
     return first, headers
 
 
-def parse_p2s_request(data: str):
+def parse_p2s_request(data: str | bytes):
     """
-    Parse a P2S request from a string.
+    Parse a P2S request from a string or raw bytes.
 
     Supported:
       ADD RFC <num> P2P-CI/1.0
       LOOKUP RFC <num> P2P-CI/1.0
       LIST ALL P2P-CI/1.0
 
-    Returns dict or None.
+    Returns a P2SRequest or None.
     """
+    if not isinstance(data, str):
+        return parse_p2s_request_bytes(data)
     first, headers = _split_message(data)
     if first is None:
         return None
@@ -64,14 +119,7 @@ def parse_p2s_request(data: str):
             port = int(headers[HEADER_PORT])
         except ValueError:
             return None
-        return {
-            "method": method,
-            "rfc_number": RFC_ALL,
-            "version": version,
-            "host": headers[HEADER_HOST],
-            "port": port,
-            "title": headers.get(HEADER_TITLE, ""),
-        }
+        return P2SRequest(method, RFC_ALL, version, headers[HEADER_HOST], port, headers.get(HEADER_TITLE, ""))
 
     if len(parts) == 4:
         method, rfc_kw, rfc_num, version = parts
@@ -89,19 +137,43 @@ def parse_p2s_request(data: str):
         except ValueError:
             return None
 
-        return {
-            "method": method,
-            "rfc_number": rfc_number,
-            "version": version,
-            "host": headers[HEADER_HOST],
-            "port": port,
-            "title": headers.get(HEADER_TITLE, ""),
-        }
+        return P2SRequest(method, rfc_number, version, headers[HEADER_HOST], port, headers.get(HEADER_TITLE, ""))
 
     return None
 
 
-def format_p2s_response(status_code: int, rfc_records=None):
+def parse_p2s_request_bytes(data):
+    """
+    Parse a P2S request straight from a receive buffer.
+
+    Accepts bytes, bytearray or a memoryview over the framed request and
+    decodes it in place, without first copying it out of the buffer.
+    Requests laid out the way format_p2s_request writes them are matched
+    in one regex pass; anything else (reordered or extra headers, odd
+    spacing) goes through the general parser.
+    """
+    m = _P2S_REQUEST_RE.fullmatch(data)
+    if m is None:
+        return parse_p2s_request(str(data, "utf-8", "replace"))
+
+    method, rfc_num, list_all, version, host, port, title = m.groups()
+    try:
+        # int() refuses digit strings past sys.get_int_max_str_digits()
+        rfc_number = int(rfc_num) if rfc_num is not None else RFC_ALL
+        port = int(port)
+    except ValueError:
+        return None
+    return P2SRequest(
+        _P2S_METHODS[method or list_all],
+        rfc_number,
+        str(version, "utf-8", "replace"),
+        str(host, "utf-8", "replace").strip(),
+        port,
+        str(title, "utf-8", "replace").strip() if title is not None else "",
+    )
+
+
+def format_p2s_response(status_code: int, rfc_records=None) -> bytes:
     """
     Server response format:
 
@@ -110,16 +182,33 @@ def format_p2s_response(status_code: int, rfc_records=None):
     RFC number <sp> RFC title <sp> hostname <sp> upload port number<cr><lf>
     ...
     <cr><lf>
+
+    Returned already encoded, ready to send.
+    """
+    return b"".join(format_p2s_response_parts(status_code, rfc_records))
+
+
+def format_p2s_response_parts(status_code: int, rfc_records=None) -> list:
+    """
+    Same response as format_p2s_response, as a list of encoded pieces.
+
+    The pieces are never joined, so the server can hand them straight to
+    sendmsg() and let the kernel gather them instead of copying a large
+    LIST response into one buffer first.
     """
     if rfc_records is None:
         rfc_records = []
 
-    phrase = STATUS_PHRASES.get(status_code, "Unknown")
-    out = f"{PROTOCOL_VERSION} {status_code} {phrase}{CRLF}{CRLF}"
-    for rfc_num, title, hostname, port in rfc_records:
-        out += f"{rfc_num} {title} {hostname} {port}{CRLF}"
-    out += CRLF  # final blank line
-    return out
+    head = _P2S_STATUS_HEADS.get(status_code)
+    if head is None:
+        head = f"{PROTOCOL_VERSION} {status_code} Unknown{CRLF}{CRLF}".encode("utf-8")
+    parts = [head]
+    parts.extend(
+        f"{rfc_num} {title} {hostname} {port}{CRLF}".encode("utf-8")
+        for rfc_num, title, hostname, port in rfc_records
+    )
+    parts.append(CRLF_BYTES)  # final blank line
+    return parts
 
 
 def parse_p2p_request(data: bytes):
@@ -130,10 +219,25 @@ def parse_p2p_request(data: bytes):
       OS: ...
       <blank line>
     """
-    try:
-        text = data.decode("utf-8", errors="replace")
-    except Exception:
-        return None
+    m = _P2P_REQUEST_RE.fullmatch(data)
+    if m is not None:
+        rfc_num, version, host, os_name = m.groups()
+        try:
+            # int() refuses digit strings past sys.get_int_max_str_digits()
+            rfc_number = int(rfc_num)
+        except ValueError:
+            return None
+        return P2PRequest(
+            METHOD_GET,
+            rfc_number,
+            str(version, "utf-8", "replace"),
+            str(host, "utf-8", "replace").strip(),
+            str(os_name, "utf-8", "replace").strip(),
+        )
+
+    # Anything laid out differently goes through the general parser;
+    # errors="replace" never raises, so undecodable bytes just fail the parse below
+    text = data.decode("utf-8", errors="replace")
 
     first, headers = _split_message(text)
     if first is None:
@@ -154,13 +258,26 @@ def parse_p2p_request(data: bytes):
     if HEADER_HOST not in headers or HEADER_OS not in headers:
         return None
 
-    return {
-        "method": method,
-        "rfc_number": rfc_number,
-        "version": version,
-        "host": headers[HEADER_HOST],
-        "os": headers[HEADER_OS],
-    }
+    return P2PRequest(method, rfc_number, version, headers[HEADER_HOST], headers[HEADER_OS])
+
+
+def format_p2p_response_parts(status_code: int, headers=None, data=None) -> list:
+    """
+    Same response as format_p2p_response, as [encoded header block, data].
+
+    The body is passed through untouched (and left out when empty), so a
+    caller can hand both pieces to sendmsg()/writelines() without first
+    copying a large file body onto the header.
+    """
+    if headers is None:
+        headers = {}
+
+    phrase = STATUS_PHRASES.get(status_code, "Unknown")
+    parts = [f"{PROTOCOL_VERSION} {status_code} {phrase}{CRLF}"]
+    parts.extend(f"{k}: {v}{CRLF}" for k, v in headers.items())
+    parts.append(CRLF)
+    header = "".join(parts).encode("utf-8")
+    return [header, data] if data else [header]
 
 
 def format_p2p_response(status_code: int, headers=None, data=None):
@@ -172,32 +289,20 @@ def format_p2p_response(status_code: int, headers=None, data=None):
       <blank line>
       <raw file bytes>
     """
-    if headers is None:
-        headers = {}
-    if data is None:
-        data = b""
-
-    phrase = STATUS_PHRASES.get(status_code, "Unknown")
-    out = f"{PROTOCOL_VERSION} {status_code} {phrase}{CRLF}"
-    for k, v in headers.items():
-        out += f"{k}: {v}{CRLF}"
-    out += CRLF
-    return out.encode("utf-8") + data
+    return b"".join(format_p2p_response_parts(status_code, headers, data))
 
 
-def format_p2s_request(method: str, rfc_number, host: str, port: int, title: str = "") -> str:
+def format_p2s_request(method: str, rfc_number, host: str, port: int, title: str = "") -> bytes:
     if method == METHOD_LIST:
         first = f"{METHOD_LIST} {RFC_ALL} {PROTOCOL_VERSION}{CRLF}"
     else:
         first = f"{method} {KEYWORD_RFC} {rfc_number} {PROTOCOL_VERSION}{CRLF}"
 
-    out = first
-    out += f"{HEADER_HOST}: {host}{CRLF}"
-    out += f"{HEADER_PORT}: {port}{CRLF}"
+    parts = [first, f"{HEADER_HOST}: {host}{CRLF}", f"{HEADER_PORT}: {port}{CRLF}"]
     if method in (METHOD_ADD, METHOD_LOOKUP):
-        out += f"{HEADER_TITLE}: {title}{CRLF}"
-    out += CRLF
-    return out
+        parts.append(f"{HEADER_TITLE}: {title}{CRLF}")
+    parts.append(CRLF)
+    return "".join(parts).encode("utf-8")
 
 
 def parse_p2s_response(text: str):
@@ -1,9 +1,14 @@
+import itertools
+import selectors
 import socket
+import sys
 import threading
 
 from src.constants import (
     SERVER_PORT,
+    CRLF_BYTES,
     PROTOCOL_VERSION,
+    PROTOCOL_VERSION_BYTES,
     STATUS_OK,
     STATUS_BAD_REQUEST,
     STATUS_NOT_FOUND,
@@ -12,110 +17,499 @@ from src.constants import (
     METHOD_LOOKUP,
     METHOD_LIST,
 )
-from src.protocol import parse_p2s_request, format_p2s_response
-from src.socket_utils import recv_message_text
+from src.protocol import parse_p2s_request_bytes, format_p2s_response_parts
+from src.socket_utils import IOV_MAX, configure_socket, recv_into_tail
+
+
+# Number of lock stripes guarding the index; must be a power of two
+NUM_STRIPES = 64
+
+
+class StripedLock:
+    """
+    A fixed array of locks, one picked per key.
+
+    stripe(key) guards the state belonging to a single key, so requests for
+    different RFCs do not serialize on one mutex. Entering the StripedLock
+    itself takes every stripe, for the rare operations (LIST, tests) that
+    need the whole index to hold still. Stripes are reentrant so a thread
+    holding everything may still call methods that take a single stripe.
+    """
+
+    def __init__(self, n: int = NUM_STRIPES):
+        self._locks = [threading.RLock() for _ in range(n)]
+        self._mask = n - 1
+
+    def slot(self, key) -> int:
+        """Index of the stripe guarding `key`."""
+        return hash(key) & self._mask
+
+    def stripe(self, key) -> threading.RLock:
+        return self._locks[hash(key) & self._mask]
+
+    def __enter__(self):
+        for lock in self._locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        for lock in reversed(self._locks):
+            lock.release()
+
+
+class RFCIndex:
+    """
+    Thread-safe in-memory RFC index.
+
+    Records are grouped by RFC number, so LOOKUP and the ADD duplicate check
+    are dict lookups under that RFC's lock stripe, and by peer, under that
+    peer's own stripe, so disconnect cleanup only touches that peer's
+    records. No lock is shared by every ADD. A change to a peer's records
+    holds that peer's stripe throughout and takes RFC stripes inside it,
+    never the other way round. Iterating yields every record newest first,
+    which is the order LIST reports them in.
+
+    `version` changes after every modification, so callers can tell whether
+    anything derived from an earlier snapshot is still current. Record
+    counts are kept per peer stripe, so len() neither scans the index nor
+    takes any lock.
+    """
+
+    def __init__(self):
+        self.lock = StripedLock()        # keyed by rfc_number
+        self._peer_locks = StripedLock()  # keyed by (hostname, upload_port)
+        self._seq = itertools.count()  # insertion order across stripes
+        self._by_rfc = {}   # rfc_number -> {(hostname, upload_port): (seq, record)}, oldest first
+        self._by_peer = {}  # (hostname, upload_port) -> set of rfc_numbers
+        self._counts = [0] * NUM_STRIPES  # records per peer stripe, kept under that stripe
+        self._versions = itertools.count(1)
+        self.version = 0     # set to a fresh value once a change is complete
+
+    def add(self, record: tuple):
+        """Insert a record, replacing the same peer's earlier record for that RFC."""
+        rfc_number, _title, host, port = record
+        peer = (host, port)
+
+        # Peer stripe first, then RFC stripe: held together, so a racing
+        # remove_peer() for this peer sees either none of the ADD or all of it
+        with self._peer_locks.stripe(peer):
+            with self.lock.stripe(rfc_number):
+                holders = self._by_rfc.setdefault(rfc_number, {})
+                replaced = holders.pop(peer, None)
+                holders[peer] = (next(self._seq), record)
+            self._by_peer.setdefault(peer, set()).add(rfc_number)
+            if replaced is None:
+                self._counts[self._peer_locks.slot(peer)] += 1
+        self._bump_version()
+
+    def lookup(self, rfc_number: int) -> list:
+        """All records for an RFC, newest first."""
+        with self.lock.stripe(rfc_number):
+            holders = self._by_rfc.get(rfc_number)
+            if not holders:
+                return []
+            return [record for _seq, record in reversed(holders.values())]
+
+    def remove_peer(self, host: str, port: int) -> int:
+        """Drop every record registered by a peer; returns how many were removed."""
+        peer = (host, port)
+        with self._peer_locks.stripe(peer):
+            rfc_numbers = self._by_peer.pop(peer, ())
+            for rfc_number in rfc_numbers:
+                with self.lock.stripe(rfc_number):
+                    holders = self._by_rfc[rfc_number]
+                    del holders[peer]
+                    if not holders:
+                        del self._by_rfc[rfc_number]
+            self._counts[self._peer_locks.slot(peer)] -= len(rfc_numbers)
+        if rfc_numbers:
+            self._bump_version()
+        return len(rfc_numbers)
+
+    def snapshot(self) -> list:
+        """Every record, newest first."""
+        with self.lock:
+            entries = [entry for holders in self._by_rfc.values() for entry in holders.values()]
+        entries.sort(reverse=True)
+        return [record for _seq, record in entries]
+
+    def clear(self):
+        with self._peer_locks, self.lock:
+            self._by_rfc.clear()
+            self._by_peer.clear()
+            self._counts = [0] * NUM_STRIPES
+        self._bump_version()
+
+    def _bump_version(self):
+        # Each value is handed out once, so even if two writers store theirs
+        # out of order, version never returns to a value a reader already saw
+        self.version = next(self._versions)
+
+    def __len__(self):
+        return sum(self._counts)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __getitem__(self, i):
+        return self.snapshot()[i]
 
 
 # In-memory database
-peers = set()  # set of (hostname, upload_port)
-index = []     # list of tuples: (rfc_number, title, hostname, upload_port)
-db_lock = threading.Lock()
+peers = {}          # hostname -> upload_port
+peers_lock = threading.Lock()
+index = RFCIndex()  # records: (rfc_number, title, hostname, upload_port)
+db_lock = index.lock  # `with db_lock:` freezes the whole index
+
+# (index.version, encoded LIST response) from the last LIST that had to format one
+_list_cache = (None, None)
+
+_VERSION_PREFIX = PROTOCOL_VERSION_BYTES.partition(b"/")[0] + b"/"  # b"P2P-CI/"
+_VERSION_NOT_SUPPORTED = format_p2s_response_parts(STATUS_VERSION_NOT_SUPPORTED)
+_BAD_REQUEST = format_p2s_response_parts(STATUS_BAD_REQUEST)
+_NOT_FOUND = format_p2s_response_parts(STATUS_NOT_FOUND)
+
+
+class StopSignal:
+    """
+    Tells a serve() loop to exit, waking it immediately.
+
+    Works like a threading.Event, but set() also writes a byte to a socket
+    pair whose read end the loop's selector watches, so an idle loop blocks
+    in select() without a timeout instead of polling a flag.
+    """
+
+    def __init__(self):
+        self._r, self._w = socket.socketpair()
+        self._r.setblocking(False)
+        self._w.setblocking(False)
+        self._set = False
+
+    def fileno(self) -> int:
+        return self._r.fileno()
+
+    def set(self):
+        self._set = True
+        try:
+            self._w.send(b"\0")
+        except OSError:
+            pass  # already signalled (buffer full) or closed
+
+    def is_set(self) -> bool:
+        return self._set
+
+    def close(self):
+        self._r.close()
+        self._w.close()
+
+
+class _PeerConn:
+    """State the event loop keeps for one connected peer."""
+
+    def __init__(self, sock: socket.socket, addr):
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = bytearray()   # receive buffer; bytes past `filled` are free space
+        self.filled = 0            # inbuf bytes received but not yet framed into a request
+        self.scan_from = 0         # inbuf offset already known to hold no CRLFCRLF
+        self.outbuf = bytearray()  # response bytes the kernel has not accepted yet
+        self.host = None           # last announced hostname
+        self.port = None           # last announced upload port
+
 
 def _remove_all_for_peer(hostname: str, upload_port: int):
-    global index, peers
     if not hostname or upload_port is None:
         return
-    with db_lock:
-        peers.discard((hostname, upload_port))
-        index = [rec for rec in index if not (rec[2] == hostname and rec[3] == upload_port)]
+    with peers_lock:
+        # Another peer on the same host may have re-registered under a new port
+        if peers.get(hostname) == upload_port:
+            del peers[hostname]
+    index.remove_peer(hostname, upload_port)
+
+
+def _list_response() -> list:
+    """
+    The LIST response for the current index, formatted at most once per version.
+
+    The version is read before the snapshot is taken and bumped only after
+    a change is complete, so a cached response is never older than the
+    version it is stored under.
+    """
+    global _list_cache
+    version = index.version
+    cached_version, response = _list_cache
+    if cached_version != version:
+        response = [b"".join(format_p2s_response_parts(STATUS_OK, index.snapshot()))]
+        _list_cache = (version, response)
+    return response
+
+
+def _handle_add(req) -> list:
+    rfc_number = req.rfc_number
+    title = req.title
+    # One shared string per hostname however many records name it; the
+    # peers and index keys then compare by identity first
+    host = sys.intern(req.host)
+    port = req.port
+
+    with peers_lock:
+        peers[host] = port
+    index.add((rfc_number, title, host, port))
+
+    print(f"[server] added RFC {rfc_number}: {title} from {host}:{port}")
+    return format_p2s_response_parts(STATUS_OK, [(rfc_number, title, host, port)])
+
+
+def _handle_lookup(req) -> list:
+    matches = index.lookup(req.rfc_number)
+    if not matches:
+        return _NOT_FOUND
+    return format_p2s_response_parts(STATUS_OK, matches)
+
 
+def _handle_list(req) -> list:
+    return _list_response()
 
 
-def _handle_peer(conn: socket.socket, addr):
-    announced_host = None
-    announced_port = None
+_HANDLERS = {
+    METHOD_ADD: _handle_add,
+    METHOD_LOOKUP: _handle_lookup,
+    METHOD_LIST: _handle_list,
+}
+
+
+def _handle_request(req, peer: _PeerConn) -> list:
+    """Process one parsed P2S request and return the encoded response pieces."""
+    if req is None:
+        return _BAD_REQUEST
+
+    if req.version != PROTOCOL_VERSION:
+        return _VERSION_NOT_SUPPORTED
+
+    peer.host = req.host
+    peer.port = req.port
+
+    handler = _HANDLERS.get(req.method)
+    if handler is None:
+        return _BAD_REQUEST
+    return handler(req)
+
+
+def _accept(sel: selectors.BaseSelector, listen_sock: socket.socket):
     try:
-        while True:
-            msg = recv_message_text(conn)
-            if msg is None:
-                break
-
-            req = parse_p2s_request(msg)
-            if req is None:
-                conn.sendall(format_p2s_response(STATUS_BAD_REQUEST).encode("utf-8"))
-                continue
-
-            if req["version"] != PROTOCOL_VERSION:
-                conn.sendall(format_p2s_response(STATUS_VERSION_NOT_SUPPORTED).encode("utf-8"))
-                continue
-
-            method = req["method"]
-            host = req["host"]
-            port = req["port"]
-            title = req.get("title", "")
-            announced_host = host
-            announced_port = port
-            
-            # Log peer connection info on first request
-            if method == METHOD_ADD or method == METHOD_LOOKUP or method == METHOD_LIST:
-                pass  # Info will be logged with each operation
-
-            if method == METHOD_ADD:
-                rfc_number = req["rfc_number"]
-
-                with db_lock:
-                    peers.add((host, port))
-                    index[:] = [rec for rec in index if not (rec[0] == rfc_number and rec[2] == host and rec[3] == port)]
-                    index.insert(0, (rfc_number, title, host, port))
-
-
-                print(f"[server] added RFC {rfc_number}: {title} from {host}:{port}")
-                conn.sendall(format_p2s_response(STATUS_OK, [(rfc_number, title, host, port)]).encode("utf-8"))
-
-            elif method == METHOD_LOOKUP:
-                rfc_number = req["rfc_number"]
-                with db_lock:
-                    matches = [rec for rec in index if rec[0] == rfc_number]
-
-                if not matches:
-                    conn.sendall(format_p2s_response(STATUS_NOT_FOUND).encode("utf-8"))
-                else:
-                    conn.sendall(format_p2s_response(STATUS_OK, matches).encode("utf-8"))
-
-            elif method == METHOD_LIST:
-                with db_lock:
-                    all_records = list(index)
-                conn.sendall(format_p2s_response(STATUS_OK, all_records).encode("utf-8"))
-
-            else:
-                conn.sendall(format_p2s_response(STATUS_BAD_REQUEST).encode("utf-8"))
-
-    except ConnectionResetError:
+        conn, addr = listen_sock.accept()
+    except BlockingIOError:
+        return
+    ip, port = addr
+    print(f"[server] connection from {ip}:{port}")
+    configure_socket(conn)
+    conn.setblocking(False)
+    sel.register(conn, selectors.EVENT_READ, data=_PeerConn(conn, addr))
+
+
+def _close_peer(sel: selectors.BaseSelector, peer: _PeerConn):
+    try:
+        sel.unregister(peer.sock)
+    except (KeyError, ValueError):
+        return  # already closed
+    try:
+        peer.sock.close()
+    except Exception:
         pass
-    finally:
+    if peer.host and peer.port:
+        print(f"[server] peer {peer.host}:{peer.port} disconnected")
+    _remove_all_for_peer(peer.host, peer.port)
+
+
+def _sendmsg(sock: socket.socket, parts: list) -> int:
+    """
+    Write as much of `parts` as the kernel takes right now; returns bytes sent.
+
+    Each sendmsg() gathers up to IOV_MAX buffers in one syscall, so a LIST
+    response goes out without first being joined into one big copy.
+    """
+    if not hasattr(sock, "sendmsg"):
+        # e.g. Windows
         try:
-            conn.close()
-        except Exception:
-            pass
-        if announced_host and announced_port:
-            print(f"[server] peer {announced_host}:{announced_port} disconnected")
-        _remove_all_for_peer(announced_host, announced_port)
+            return sock.send(b"".join(parts))
+        except BlockingIOError:
+            return 0
 
+    sent = 0
+    for i in range(0, len(parts), IOV_MAX):
+        batch = parts[i : i + IOV_MAX]
+        try:
+            n = sock.sendmsg(batch)
+        except BlockingIOError:
+            break
+        sent += n
+        if n < sum(map(len, batch)):
+            break
+    return sent
 
-def main():
+
+def _send(sel: selectors.BaseSelector, peer: _PeerConn, parts: list):
+    """
+    Send a response without blocking.
+
+    Whatever the kernel does not take right away is queued on the peer and
+    flushed by _on_writable once the socket reports EVENT_WRITE. Until
+    then the peer is watched for EVENT_WRITE only: a client that keeps
+    pipelining requests without reading the replies stops being read,
+    instead of growing outbuf without bound.
+    """
+    if peer.outbuf:
+        for part in parts:
+            peer.outbuf += part
+        return
+
+    sent = _sendmsg(peer.sock, parts)
+    for part in parts:
+        if sent >= len(part):
+            sent -= len(part)
+            continue
+        peer.outbuf += memoryview(part)[sent:]
+        sent = 0
+    if peer.outbuf:
+        sel.modify(peer.sock, selectors.EVENT_WRITE, data=peer)
+
+
+def _on_writable(sel: selectors.BaseSelector, peer: _PeerConn):
+    try:
+        sent = peer.sock.send(peer.outbuf)
+    except BlockingIOError:
+        return
+    del peer.outbuf[:sent]
+    if not peer.outbuf:
+        sel.modify(peer.sock, selectors.EVENT_READ, data=peer)
+        # Answer requests that were already received while output was blocked
+        _process_requests(sel, peer)
+
+
+def _unsupported_version(buf: bytearray, line_start: int, line_end: int) -> bool:
+    """
+    True if the request line buf[line_start:line_end] ends in a P2P-CI
+    version we don't speak.
+
+    Checked on the raw bytes so such requests are answered 505 without
+    being decoded or parsed; anything else is left to the full parser.
+    """
+    start = buf.rfind(b" ", line_start, line_end) + 1 or line_start
+    if not buf.startswith(_VERSION_PREFIX, start, line_end):
+        return False
+    return line_end - start != len(PROTOCOL_VERSION_BYTES) or not buf.startswith(PROTOCOL_VERSION_BYTES, start)
+
+
+def _on_readable(sel: selectors.BaseSelector, peer: _PeerConn):
+    buf = peer.inbuf
+    try:
+        n = recv_into_tail(peer.sock, buf, peer.filled)
+    except BlockingIOError:
+        return
+    if not n:
+        _close_peer(sel, peer)
+        return
+    peer.filled += n
+    _process_requests(sel, peer)
+
+
+def _process_requests(sel: selectors.BaseSelector, peer: _PeerConn):
+    """
+    Answer the complete requests in the peer's inbuf, in order.
+
+    Stops early once a response could not be sent in full; the rest stay
+    buffered until _on_writable has flushed outbuf.
+    """
+    buf = peer.inbuf
+    filled = peer.filled
+    start = 0
+    # A single recv may carry several pipelined requests, or only part of one
+    while not peer.outbuf:
+        end = buf.find(b"\r\n\r\n", peer.scan_from, filled)
+        if end < 0:
+            # Only the last 3 bytes could start a marker split across recvs
+            peer.scan_from = max(start, filled - 3)
+            break
+        end += 4
+        if _unsupported_version(buf, start, buf.find(CRLF_BYTES, start, end)):
+            response = _VERSION_NOT_SUPPORTED
+        else:
+            with memoryview(buf)[start:end] as frame:
+                req = parse_p2s_request_bytes(frame)
+            response = _handle_request(req, peer)
+        start = peer.scan_from = end
+        _send(sel, peer, response)
+
+    # Drop everything framed by this pass in one go
+    if start:
+        del buf[:start]
+        filled -= start
+        peer.scan_from -= start
+    peer.filled = filled
+
+
+def serve(listen_sock: socket.socket, stop: StopSignal = None):
+    """
+    Serve peers on an already listening socket until `stop` is set.
+
+    A single thread multiplexes every peer connection through a selector
+    (epoll on Linux) instead of dedicating a thread to each peer. With
+    nothing to do it sleeps in select() until a peer or `stop` wakes it.
+    """
+    listen_sock.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(listen_sock, selectors.EVENT_READ, data=None)
+    if stop is not None:
+        sel.register(stop, selectors.EVENT_READ, data=stop)
+
+    try:
+        while stop is None or not stop.is_set():
+            for key, mask in sel.select():
+                if key.data is None:
+                    _accept(sel, key.fileobj)
+                    continue
+                if key.data is stop:
+                    continue  # loop condition sees the flag
+
+                peer = key.data
+                try:
+                    if mask & selectors.EVENT_READ:
+                        _on_readable(sel, peer)
+                    if mask & selectors.EVENT_WRITE and peer.outbuf:
+                        _on_writable(sel, peer)
+                except OSError:
+                    # Covers ConnectionResetError / BrokenPipeError from the peer
+                    _close_peer(sel, peer)
+                except Exception as e:
+                    # A bug handling one peer must not take down every other
+                    # peer on this loop
+                    print(f"[server] error serving {peer.addr[0]}:{peer.addr[1]}: {e!r}")
+                    _close_peer(sel, peer)
+    finally:
+        for key in list(sel.get_map().values()):
+            if isinstance(key.data, _PeerConn):
+                _close_peer(sel, key.data)
+        sel.close()
+
+
+def _listen() -> socket.socket:
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Set before listen() so accepted sockets start with the large buffers
+    configure_socket(sock)
     sock.bind(("0.0.0.0", SERVER_PORT))
     sock.listen()
+    return sock
+
+
+def main():
+    # One plain listener and one loop. A second server on this port fails
+    # with EADDRINUSE instead of silently splitting peers between two
+    # indexes, and extra loop threads would only take turns on the GIL
+    sock = _listen()
     print(f"[server] listening on port {SERVER_PORT}")
 
-    while True:
-        conn, addr = sock.accept()
-        # addr is (ip, port) tuple
-        ip, port = addr
-        print(f"[server] connection from {ip}:{port}")
-        t = threading.Thread(target=_handle_peer, args=(conn, addr), daemon=True)
-        t.start()
+    serve(sock)
 
 
 if __name__ == "__main__":
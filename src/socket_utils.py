@@ -2,34 +2,150 @@
 Socket utilities for reading protocol messages
 """
 
+import os
 import socket
-from src.constants import BUFFER_SIZE, CRLF
+from collections import deque
+from src.constants import BUFFER_SIZE, RECV_CHUNK, SOCKET_BUFFER_SIZE
 
+# Most buffers a single sendmsg()/writev() call accepts
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16  # POSIX minimum
 
-def recv_until_marker(sock: socket.socket, marker: bytes = b"\r\n\r\n") -> bytes | None:
+# Scratch receive buffers handed back by the helpers below once their
+# contents have been copied out, so each message read does not allocate
+# (and zero) a fresh RECV_CHUNK buffer. deque append/popleft are atomic,
+# so threads can share the pool without a lock.
+_BUF_POOL = deque()
+_BUF_POOL_MAX = 64
+
+
+def _get_buf() -> bytearray:
+    try:
+        return _BUF_POOL.popleft()
+    except IndexError:
+        return bytearray(RECV_CHUNK)
+
+
+def _put_buf(buf: bytearray):
+    if len(_BUF_POOL) >= _BUF_POOL_MAX:
+        return
+    # Don't let one oversized message pin a large buffer in the pool
+    if len(buf) > RECV_CHUNK:
+        del buf[RECV_CHUNK:]
+    elif len(buf) < RECV_CHUNK:
+        buf.extend(bytes(RECV_CHUNK - len(buf)))
+    _BUF_POOL.append(buf)
+
+
+def configure_socket(sock: socket.socket) -> socket.socket:
     """
-    Read from socket until marker is found.
-    Returns bytes up to and including marker, or None if connection closed.
+    Apply the TCP options used on every connected socket.
+
+    Disables Nagle so small requests and response headers are not held back
+    waiting for an ACK, and raises the kernel send/receive buffers so bulk
+    RFC transfers are not capped by the default window. The receive buffer
+    size picks the TCP window scale during the handshake, so it is best
+    applied to listening sockets before listen(); accepted sockets inherit it.
     """
-    buf = b""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    return sock
+
+
+def send_message(sock: socket.socket, parts: list):
+    """
+    Send every buffer in `parts`, in order, on a blocking socket.
+
+    sendmsg() gathers up to IOV_MAX buffers per syscall, so the pieces never
+    have to be joined into one string first; a partial write resumes from
+    the first unsent byte.
+    """
+    if not hasattr(sock, "sendmsg"):
+        # e.g. Windows
+        sock.sendall(b"".join(parts))
+        return
+
+    parts = list(parts)
+    i = 0
+    while i < len(parts):
+        sent = sock.sendmsg(parts[i : i + IOV_MAX])
+        while i < len(parts) and sent >= len(parts[i]):
+            sent -= len(parts[i])
+            i += 1
+        if sent:
+            parts[i] = memoryview(parts[i])[sent:]
+
+
+def recv_into_tail(sock: socket.socket, buf: bytearray, filled: int, size: int = BUFFER_SIZE) -> int:
+    """
+    Receive up to `size` bytes straight into the unused tail of `buf`;
+    returns bytes read.
+
+    `buf` is doubled first when less than `size` is free, so each recv
+    writes into preallocated memory instead of allocating a new chunk that
+    then has to be copied onto the buffer.
+    """
+    if len(buf) - filled < size:
+        buf.extend(bytes(max(len(buf), size)))
+    with memoryview(buf)[filled:] as tail:
+        return sock.recv_into(tail, size)
+
+
+def recv_until_marker(
+    sock: socket.socket, marker: bytes = b"\r\n\r\n", size: int = BUFFER_SIZE
+) -> bytearray | None:
+    """
+    Read from socket, up to `size` bytes per recv, until marker is found.
+    Returns everything read so far (the marker and any bytes that arrived
+    after it in the same read), or None if connection closed. The receive
+    buffer itself is returned rather than a bytes copy of it.
+    """
+    buf = bytearray(size)
+    filled = _recv_until_marker_into(sock, buf, marker, size)
+    if filled < 0:
+        return None
+    del buf[filled:]
+    return buf
+
+
+def _recv_until_marker_into(sock: socket.socket, buf: bytearray, marker: bytes, size: int) -> int:
+    """
+    Fill `buf` from the start until it holds `marker`; returns the number of
+    bytes read, or -1 if the connection closed first. `buf` may be grown.
+    """
+    filled = 0
+    scan_from = 0
     while True:
-        chunk = sock.recv(BUFFER_SIZE)
-        if not chunk:
-            return None
-        buf += chunk
-        if marker in buf:
-            return buf
+        n = recv_into_tail(sock, buf, filled, size)
+        if not n:
+            return -1
+        filled += n
+        if buf.find(marker, scan_from, filled) >= 0:
+            return filled
+        # Bytes before this point are known not to start a marker
+        scan_from = max(0, filled - len(marker) + 1)
 
 
 def recv_message_text(sock: socket.socket) -> str | None:
     """
     Read a complete message (headers + blank line) and return as text.
     Returns None if connection closed.
+
+    Reads RECV_CHUNK at a time so a whole message, including any records
+    after the blank line, normally arrives in a single recv.
     """
-    buf = recv_until_marker(sock, b"\r\n\r\n")
-    if buf is None:
-        return None
-    return buf.decode("utf-8", errors="replace")
+    buf = _get_buf()
+    try:
+        filled = _recv_until_marker_into(sock, buf, b"\r\n\r\n", RECV_CHUNK)
+        if filled < 0:
+            return None
+        with memoryview(buf)[:filled] as view:
+            return str(view, "utf-8", "replace")
+    finally:
+        _put_buf(buf)
 
 
 def recv_p2s_response(sock: socket.socket) -> bytes:
@@ -37,28 +153,102 @@ def recv_p2s_response(sock: socket.socket) -> bytes:
     Read a P2S response which ends with blank line after data.
     Returns complete response as bytes (may be empty if connection closes).
     """
-    buf = b""
-
-    # Read until first CRLFCRLF (end of status line and headers)
-    while b"\r\n\r\n" not in buf:
-        chunk = sock.recv(BUFFER_SIZE)
-        if not chunk:
-            return buf
-        buf += chunk
-
-    head, rest = buf.split(b"\r\n\r\n", 1)
-
-    # Read until we see CRLFCRLF again (blank line after data)
-    # Note: For responses with no records (like 404), rest may already be just "\r\n"
-    # In that case, we should return immediately instead of blocking.
-    while b"\r\n\r\n" not in rest:
-        # Check if rest is just a blank line (empty record section)
-        if rest == b"\r\n":
-            return head + b"\r\n\r\n" + rest
-        
-        chunk = sock.recv(BUFFER_SIZE)
-        if not chunk:
+    buf = _get_buf()
+    try:
+        return _recv_p2s_response_into(sock, buf)
+    finally:
+        _put_buf(buf)
+
+
+def _recv_p2s_response_into(sock: socket.socket, buf: bytearray) -> bytes:
+    filled = 0
+    scan_from = 0    # offset already known to hold no CRLFCRLF
+    head_end = -1    # offset just past the status line's blank line, once seen
+    while True:
+        n = recv_into_tail(sock, buf, filled, RECV_CHUNK)
+        if not n:
+            break
+        filled += n
+
+        if head_end < 0:
+            idx = buf.find(b"\r\n\r\n", scan_from, filled)
+            if idx < 0:
+                scan_from = max(0, filled - 3)
+                continue
+            head_end = scan_from = idx + 4
+
+        # A blank line straight after the header means no records (e.g. 404),
+        # so don't block waiting for a second CRLFCRLF
+        if filled - head_end >= 2 and buf[head_end : head_end + 2] == b"\r\n":
             break
-        rest += chunk
+        if buf.find(b"\r\n\r\n", scan_from, filled) >= 0:
+            break
+        scan_from = max(head_end, filled - 3)
+
+    with memoryview(buf)[:filled] as view:
+        return bytes(view)
+
+
+def recv_p2s_responses(sock: socket.socket, count: int) -> list[bytes]:
+    """
+    Read `count` pipelined P2S responses, in order.
+
+    Responses may arrive split across reads or several to a read; each is
+    cut at its own boundary. Returns fewer than `count` if the connection
+    closes first.
 
-    return head + b"\r\n\r\n" + rest
+    Like recv_p2s_response, scanning resumes where the last read left off
+    rather than from the start of the response, and bytes of responses
+    already returned are dropped before the next read.
+    """
+    buf = _get_buf()
+    try:
+        return _recv_p2s_responses_into(sock, buf, count)
+    finally:
+        _put_buf(buf)
+
+
+def _recv_p2s_responses_into(sock: socket.socket, buf: bytearray, count: int) -> list[bytes]:
+    filled = 0
+    start = 0        # offset where the current response begins
+    scan_from = 0    # offset already known to hold no CRLFCRLF
+    head_end = -1    # offset just past the current status line's blank line, once seen
+    responses = []
+    while len(responses) < count:
+        end = -1
+        if head_end < 0:
+            idx = buf.find(b"\r\n\r\n", scan_from, filled)
+            if idx >= 0:
+                head_end = scan_from = idx + 4
+            else:
+                scan_from = max(start, filled - 3)
+        if head_end >= 0 and filled - head_end >= 2:
+            if buf[head_end : head_end + 2] == b"\r\n":
+                end = head_end + 2  # no records
+            else:
+                idx = buf.find(b"\r\n\r\n", scan_from, filled)
+                if idx >= 0:
+                    end = idx + 4
+                else:
+                    scan_from = max(head_end, filled - 3)
+
+        if end >= 0:
+            with memoryview(buf)[start:end] as view:
+                responses.append(bytes(view))
+            start = scan_from = end
+            head_end = -1
+            continue
+
+        # Need more bytes; first drop the responses already returned
+        if start:
+            del buf[:start]
+            filled -= start
+            scan_from -= start
+            if head_end >= 0:
+                head_end -= start
+            start = 0
+        n = recv_into_tail(sock, buf, filled, RECV_CHUNK)
+        if not n:
+            break
+        filled += n
+    return responses
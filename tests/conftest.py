@@ -2,6 +2,8 @@
 Pytest configuration and shared fixtures for project_1 tests.
 """
 
+import time
+
 import pytest
 
 
@@ -16,3 +18,22 @@ def pytest_configure(config):
     config.addinivalue_line(
         "markers", "integration: marks tests as integration tests"
     )
+
+
+@pytest.fixture
+def wait_until():
+    """
+    Poll `condition()` until it is true or `timeout` seconds have passed.
+
+    Returns the last result, so tests can `assert wait_until(...)` on state
+    the server updates asynchronously (e.g. cleanup after a disconnect).
+    """
+    def wait(condition, timeout=2.0, interval=0.001):
+        deadline = time.monotonic() + timeout
+        while True:
+            result = condition()
+            if result or time.monotonic() >= deadline:
+                return result
+            time.sleep(interval)
+
+    return wait
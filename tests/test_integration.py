@@ -5,6 +5,7 @@ End-to-end tests with real server, peers, file I/O, and network operations.
 Tests the complete workflow: registration, upload server, downloads.
 """
 
+import json
 import os
 import shutil
 import socket
@@ -20,7 +21,7 @@ from src.constants import (
     METHOD_LOOKUP,
     METHOD_LIST,
 )
-from src.peer import UploadServer, download_rfc, find_local_rfcs
+from src.peer import TITLE_CACHE_FILE, UploadServer, download_rfc, find_local_rfcs
 from src.protocol import format_p2s_request, parse_p2s_response
 from src.socket_utils import recv_message_text
 from src import server
@@ -45,37 +46,20 @@ def server_thread():
     server.peers.clear()
     server.index.clear()
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Listen exactly as the server does; a dev server already on the port
+    # makes this fail instead of sharing connections with it
+    sock = server._listen()
 
-    def server_main_local():
-        sock.bind(("0.0.0.0", SERVER_PORT))
-        sock.listen()
-        sock.settimeout(0.5)
-
-        while getattr(server_thread, "running", True):
-            try:
-                conn, addr = sock.accept()
-                t = threading.Thread(target=server._handle_peer, args=(conn, addr), daemon=True)
-                t.start()
-            except socket.timeout:
-                continue
-            except Exception:
-                break
-
-    t = threading.Thread(target=server_main_local, daemon=True)
+    stop = server.StopSignal()
+    t = threading.Thread(target=server.serve, args=(sock, stop), daemon=True)
     t.start()
-    server_thread.running = True
-    time.sleep(0.1)
 
     yield
 
-    server_thread.running = False
-    try:
-        sock.close()
-    except Exception:
-        pass
-    time.sleep(0.1)
+    stop.set()
+    t.join()
+    stop.close()
+    sock.close()
 
 
 @pytest.fixture
@@ -156,6 +140,36 @@ class TestRFCDiscovery:
         assert len(rfcs) == 3
         assert [r[0] for r in rfcs] == [100, 200, 300]
 
+    def test_find_local_rfcs_caches_titles(self, peer1_data):
+        """Titles are memoized on disk and reused for unchanged files."""
+        find_local_rfcs(peer1_data)
+
+        cache_path = os.path.join(peer1_data, TITLE_CACHE_FILE)
+        with open(cache_path) as f:
+            cache = json.load(f)
+        assert set(cache) == {"rfc100.txt", "rfc200.txt"}
+
+        # An unchanged file is answered from the cache, not by reopening it
+        cache["rfc100.txt"][2] = "Cached Title"
+        with open(cache_path, "w") as f:
+            json.dump(cache, f)
+
+        rfcs = find_local_rfcs(peer1_data)
+        assert rfcs[0][1] == "Cached Title"
+
+    def test_find_local_rfcs_refreshes_changed_title(self, peer1_data):
+        """A modified file gets its title re-read."""
+        find_local_rfcs(peer1_data)
+
+        rfc_path = os.path.join(peer1_data, "rfc100.txt")
+        with open(rfc_path, "w") as f:
+            f.write("RFC 100: Revised Title\n")
+        st = os.stat(rfc_path)
+        os.utime(rfc_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+        rfcs = find_local_rfcs(peer1_data)
+        assert "Revised Title" in rfcs[0][1]
+
 
 # ============================================================================
 # UPLOAD SERVER TESTS
@@ -176,6 +190,28 @@ class TestUploadServer:
 
         upload.stop()
 
+    def test_upload_server_stops_with_idle_connection(self, peer1_data):
+        """stop() returns promptly while a client is connected but has sent nothing."""
+        upload = UploadServer(peer1_data)
+        upload.start()
+
+        sock = socket.create_connection(("127.0.0.1", upload.port), timeout=2)
+        try:
+            sock.sendall(b"GET RFC 100 P2P-CI/1.0\r\n")  # request never finished
+            time.sleep(0.05)  # let the upload loop accept it
+
+            started = time.monotonic()
+            upload.stop()
+            assert time.monotonic() - started < 2
+            assert not upload._thread.is_alive()
+            # The connection was dropped rather than left hanging
+            try:
+                assert sock.recv(1024) == b""
+            except ConnectionResetError:
+                pass
+        finally:
+            sock.close()
+
     def test_upload_server_serves_rfc(self, peer1_data):
         """Upload server serves RFC files over P2P protocol."""
         upload = UploadServer(peer1_data)
@@ -237,6 +273,80 @@ class TestUploadServer:
         finally:
             upload.stop()
 
+    def test_upload_server_returns_400_for_oversized_rfc_number(self, peer1_data):
+        """An RFC number too long for int() is a 400, and the upload server keeps serving."""
+        upload = UploadServer(peer1_data)
+        upload.start()
+
+        try:
+            sock = socket.create_connection(("127.0.0.1", upload.port), timeout=2)
+            req = (
+                f"GET RFC {'9' * 5000} P2P-CI/1.0\r\n"
+                f"Host: testhost\r\n"
+                f"OS: TestOS\r\n"
+                f"\r\n"
+            )
+            sock.sendall(req.encode("utf-8"))
+
+            buf = b""
+            while True:
+                chunk = sock.recv(1024)
+                if not chunk:
+                    break
+                buf += chunk
+            sock.close()
+
+            assert b"400 Bad Request" in buf
+            success, _ = download_rfc("127.0.0.1", upload.port, 100, os.path.join(peer1_data, "copy.txt"))
+            assert success
+        finally:
+            upload.stop()
+
+    def test_download_large_rfc(self, peer1_data, peer2_data):
+        """Download spanning many receive calls arrives intact."""
+        content = b"RFC 4000: Large Document\n" + bytes(range(256)) * 8192  # ~2 MB
+        with open(os.path.join(peer1_data, "rfc4000.txt"), "wb") as f:
+            f.write(content)
+
+        upload = UploadServer(peer1_data)
+        upload.start()
+
+        try:
+            download_path = os.path.join(peer2_data, "rfc4000.txt")
+            success, size = download_rfc("127.0.0.1", upload.port, 4000, download_path)
+
+            assert success
+            assert size == len(content)
+            with open(download_path, "rb") as f:
+                assert f.read() == content
+        finally:
+            upload.stop()
+
+
+    def test_download_cut_off_mid_body(self, peer2_data):
+        """A sender closing before Content-Length arrives fails the download and leaves no file."""
+        listener = socket.create_server(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+
+        def truncated_sender():
+            conn, _ = listener.accept()
+            with conn:
+                conn.recv(1024)
+                conn.sendall(b"P2P-CI/1.0 200 OK\r\nContent-Length: 1000\r\n\r\n" + b"x" * 100)
+
+        t = threading.Thread(target=truncated_sender)
+        t.start()
+        try:
+            download_path = os.path.join(peer2_data, "rfc500.txt")
+            success, size = download_rfc("127.0.0.1", port, 500, download_path)
+        finally:
+            t.join()
+            listener.close()
+
+        assert not success
+        assert size == 100
+        assert os.listdir(peer2_data) == []
+
 
 # ============================================================================
 # END-TO-END WORKFLOW TESTS
@@ -253,7 +363,7 @@ class TestEndToEndWorkflow:
         p1_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
 
         req = format_p2s_request(METHOD_ADD, 100, "127.0.0.1", 5000, "RFC 100: Simple Explanation")
-        p1_sock.sendall(req.encode("utf-8"))
+        p1_sock.sendall(req)
         resp = recv_message_text(p1_sock)
         status, records = parse_p2s_response(resp)
         assert status == 200
@@ -262,7 +372,7 @@ class TestEndToEndWorkflow:
         p2_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
 
         req = format_p2s_request(METHOD_LOOKUP, 100, "127.0.0.1", 5001, "")
-        p2_sock.sendall(req.encode("utf-8"))
+        p2_sock.sendall(req)
         resp = recv_message_text(p2_sock)
         status, records = parse_p2s_response(resp)
 
@@ -281,19 +391,19 @@ class TestEndToEndWorkflow:
         p1_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
 
         p1_sock.sendall(
-            format_p2s_request(METHOD_ADD, 100, "127.0.0.1", 5000, "RFC 100").encode("utf-8")
+            format_p2s_request(METHOD_ADD, 100, "127.0.0.1", 5000, "RFC 100")
         )
         recv_message_text(p1_sock)
 
         p1_sock.sendall(
-            format_p2s_request(METHOD_ADD, 200, "127.0.0.1", 5000, "RFC 200").encode("utf-8")
+            format_p2s_request(METHOD_ADD, 200, "127.0.0.1", 5000, "RFC 200")
         )
         recv_message_text(p1_sock)
 
         # Peer 2: LIST all
         p2_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
 
-        p2_sock.sendall(format_p2s_request(METHOD_LIST, "ALL", "127.0.0.1", 5001, "").encode("utf-8"))
+        p2_sock.sendall(format_p2s_request(METHOD_LIST, "ALL", "127.0.0.1", 5001, ""))
         resp = recv_message_text(p2_sock)
         status, records = parse_p2s_response(resp)
 
@@ -313,14 +423,14 @@ class TestEndToEndWorkflow:
             # Peer 1: register RFC with server
             p1_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
             p1_sock.sendall(
-                format_p2s_request(METHOD_ADD, 100, "127.0.0.1", upload.port, "RFC 100").encode("utf-8")
+                format_p2s_request(METHOD_ADD, 100, "127.0.0.1", upload.port, "RFC 100")
             )
             recv_message_text(p1_sock)
             time.sleep(0.1)  # Ensure server processes ADD
 
             # Peer 2: lookup RFC
             p2_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
-            p2_sock.sendall(format_p2s_request(METHOD_LOOKUP, 100, "127.0.0.1", 5001, "").encode("utf-8"))
+            p2_sock.sendall(format_p2s_request(METHOD_LOOKUP, 100, "127.0.0.1", 5001, ""))
             resp = recv_message_text(p2_sock)
             status, records = parse_p2s_response(resp)
 
@@ -330,7 +440,7 @@ class TestEndToEndWorkflow:
 
             # Peer 2: download RFC from Peer 1
             download_path = os.path.join(peer2_data, "rfc100.txt")
-            success, data = download_rfc(host, port, 100, download_path)
+            success, _size = download_rfc(host, port, 100, download_path)
 
             assert success
             assert os.path.exists(download_path)
@@ -351,7 +461,7 @@ class TestEndToEndWorkflow:
         # Peer 1: register one RFC
         p1_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
         p1_sock.sendall(
-            format_p2s_request(METHOD_ADD, 100, "127.0.0.1", 5000, "RFC 100").encode("utf-8")
+            format_p2s_request(METHOD_ADD, 100, "127.0.0.1", 5000, "RFC 100")
         )
         recv_message_text(p1_sock)
         time.sleep(0.1)
@@ -359,14 +469,14 @@ class TestEndToEndWorkflow:
         # Peer 2: register one RFC
         p2_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
         p2_sock.sendall(
-            format_p2s_request(METHOD_ADD, 200, "127.0.0.1", 5001, "RFC 200").encode("utf-8")
+            format_p2s_request(METHOD_ADD, 200, "127.0.0.1", 5001, "RFC 200")
         )
         recv_message_text(p2_sock)
         time.sleep(0.1)
 
         # Peer 3: list all
         p3_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
-        p3_sock.sendall(format_p2s_request(METHOD_LIST, "ALL", "127.0.0.1", 5002, "").encode("utf-8"))
+        p3_sock.sendall(format_p2s_request(METHOD_LIST, "ALL", "127.0.0.1", 5002, ""))
         resp = recv_message_text(p3_sock)
         status, records = parse_p2s_response(resp)
 
@@ -379,18 +489,18 @@ class TestEndToEndWorkflow:
         p2_sock.close()
         p3_sock.close()
 
-    def test_peer_disconnect_cleanup(self, server_thread):
+    def test_peer_disconnect_cleanup(self, server_thread, wait_until):
         """When peer disconnects, its RFCs are removed from index."""
         # Peer 1: register RFC
         p1_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
         p1_sock.sendall(
-            format_p2s_request(METHOD_ADD, 100, "127.0.0.1", 5000, "RFC 100").encode("utf-8")
+            format_p2s_request(METHOD_ADD, 100, "127.0.0.1", 5000, "RFC 100")
         )
         recv_message_text(p1_sock)
 
         # Peer 2: verify it's there
         p2_sock = socket.create_connection(("127.0.0.1", SERVER_PORT), timeout=2)
-        p2_sock.sendall(format_p2s_request(METHOD_LOOKUP, 100, "127.0.0.1", 5001, "").encode("utf-8"))
+        p2_sock.sendall(format_p2s_request(METHOD_LOOKUP, 100, "127.0.0.1", 5001, ""))
         resp = recv_message_text(p2_sock)
         status, records = parse_p2s_response(resp)
         assert status == 200
@@ -398,10 +508,10 @@ class TestEndToEndWorkflow:
 
         # Peer 1: disconnect
         p1_sock.close()
-        time.sleep(0.2)
+        assert wait_until(lambda: len(server.index) == 0)
 
         # Peer 2: should not find it anymore
-        p2_sock.sendall(format_p2s_request(METHOD_LOOKUP, 100, "127.0.0.1", 5001, "").encode("utf-8"))
+        p2_sock.sendall(format_p2s_request(METHOD_LOOKUP, 100, "127.0.0.1", 5001, ""))
         resp = recv_message_text(p2_sock)
         status, records = parse_p2s_response(resp)
 
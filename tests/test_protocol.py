@@ -29,11 +29,14 @@ from src.constants import (
 )
 from src.protocol import (
     parse_p2s_request,
+    parse_p2s_request_bytes,
     format_p2s_request,
     format_p2s_response,
+    format_p2s_response_parts,
     parse_p2s_response,
     parse_p2p_request,
     format_p2p_response,
+    format_p2p_response_parts,
 )
 
 
@@ -58,12 +61,12 @@ class TestP2SRequestParsing:
         result = parse_p2s_request(req)
 
         assert result is not None
-        assert result["method"] == METHOD_ADD
-        assert result["rfc_number"] == 123
-        assert result["version"] == PROTOCOL_VERSION
-        assert result["host"] == "host.example.com"
-        assert result["port"] == 5678
-        assert result["title"] == "A Test RFC Title"
+        assert result.method == METHOD_ADD
+        assert result.rfc_number == 123
+        assert result.version == PROTOCOL_VERSION
+        assert result.host == "host.example.com"
+        assert result.port == 5678
+        assert result.title == "A Test RFC Title"
 
     def test_parse_add_request_multiword_title(self):
         """ADD request with multi-word title."""
@@ -77,7 +80,7 @@ class TestP2SRequestParsing:
         result = parse_p2s_request(req)
 
         assert result is not None
-        assert result["title"] == "A Proferred Official ICP Specification"
+        assert result.title == "A Proferred Official ICP Specification"
 
     def test_parse_lookup_request_valid(self):
         """Valid LOOKUP request."""
@@ -91,8 +94,8 @@ class TestP2SRequestParsing:
         result = parse_p2s_request(req)
 
         assert result is not None
-        assert result["method"] == METHOD_LOOKUP
-        assert result["rfc_number"] == 3457
+        assert result.method == METHOD_LOOKUP
+        assert result.rfc_number == 3457
 
     def test_parse_list_request_valid(self):
         """Valid LIST request with ALL."""
@@ -105,8 +108,8 @@ class TestP2SRequestParsing:
         result = parse_p2s_request(req)
 
         assert result is not None
-        assert result["method"] == METHOD_LIST
-        assert result["rfc_number"] == RFC_ALL
+        assert result.method == METHOD_LIST
+        assert result.rfc_number == RFC_ALL
 
     def test_parse_request_missing_host_header(self):
         """Request missing required Host header."""
@@ -212,7 +215,44 @@ class TestP2SRequestParsing:
         result = parse_p2s_request(req)
 
         assert result is not None
-        assert result.get("title") == ""
+        assert result.title == ""
+
+    def test_parse_request_from_memoryview(self):
+        """Request parsed directly from a slice of a receive buffer."""
+        buf = bytearray(
+            (
+                f"ADD RFC 123 {PROTOCOL_VERSION}{CRLF}"
+                f"{HEADER_HOST}: host.example.com{CRLF}"
+                f"{HEADER_PORT}: 5678{CRLF}"
+                f"{HEADER_TITLE}: Test{CRLF}"
+                f"{CRLF}"
+                f"LIST ALL"  # start of the next pipelined request
+            ).encode("utf-8")
+        )
+        end = buf.find(b"\r\n\r\n") + 4
+
+        with memoryview(buf)[:end] as frame:
+            result = parse_p2s_request_bytes(frame)
+
+        assert result is not None
+        assert result.rfc_number == 123
+        assert result.host == "host.example.com"
+
+    def test_parse_request_bytes_matches_text_parser(self):
+        """Canonical and reordered requests parse the same from bytes as from text."""
+        reqs = [
+            format_p2s_request(METHOD_ADD, 123, "host.example.com", 5678, "A Test RFC Title"),
+            format_p2s_request(METHOD_LIST, RFC_ALL, "host.example.com", 5678, ""),
+            (
+                f"LOOKUP RFC 7 {PROTOCOL_VERSION}{CRLF}"
+                f"{HEADER_PORT}: 5678{CRLF}"
+                f"{HEADER_HOST}:  host.example.com {CRLF}"
+                f"{CRLF}"
+            ).encode("utf-8"),
+            f"ADD {RFC_ALL} {PROTOCOL_VERSION}{CRLF}{HEADER_HOST}: h{CRLF}{HEADER_PORT}: 1{CRLF}{CRLF}".encode("utf-8"),
+        ]
+        for req in reqs:
+            assert parse_p2s_request_bytes(req) == parse_p2s_request(req.decode("utf-8"))
 
 
 # ============================================================================
@@ -234,7 +274,7 @@ class TestP2SRequestFormatting:
             f"{HEADER_PORT}: 5678{CRLF}"
             f"{HEADER_TITLE}: Test RFC{CRLF}"
             f"{CRLF}"
-        )
+        ).encode("utf-8")
         assert req == expected
 
     def test_format_lookup_request(self):
@@ -247,7 +287,7 @@ class TestP2SRequestFormatting:
             f"{HEADER_PORT}: 7000{CRLF}"
             f"{HEADER_TITLE}: Some RFC{CRLF}"
             f"{CRLF}"
-        )
+        ).encode("utf-8")
         assert req == expected
 
     def test_format_list_request(self):
@@ -259,7 +299,7 @@ class TestP2SRequestFormatting:
             f"{HEADER_HOST}: host.example.com{CRLF}"
             f"{HEADER_PORT}: 5678{CRLF}"
             f"{CRLF}"
-        )
+        ).encode("utf-8")
         assert req == expected
 
     def test_format_request_with_multiword_title(self):
@@ -268,8 +308,8 @@ class TestP2SRequestFormatting:
             METHOD_ADD, 789, "host.example.com", 5678, "A Proferred Official ICP"
         )
 
-        assert "A Proferred Official ICP" in req
-        assert f"{HEADER_TITLE}: A Proferred Official ICP{CRLF}" in req
+        assert b"A Proferred Official ICP" in req
+        assert f"{HEADER_TITLE}: A Proferred Official ICP{CRLF}".encode("utf-8") in req
 
 
 # ============================================================================
@@ -289,42 +329,53 @@ class TestP2SResponseFormatting:
         ]
         resp = format_p2s_response(STATUS_OK, records)
 
-        assert f"{PROTOCOL_VERSION} 200 OK{CRLF}{CRLF}" in resp
-        assert "123 Test RFC host1.example.com 5001" in resp
-        assert "123 Test RFC host2.example.com 5002" in resp
-        assert resp.endswith(CRLF)
+        assert f"{PROTOCOL_VERSION} 200 OK{CRLF}{CRLF}".encode("utf-8") in resp
+        assert b"123 Test RFC host1.example.com 5001" in resp
+        assert b"123 Test RFC host2.example.com 5002" in resp
+        assert resp.endswith(CRLF.encode("utf-8"))
 
     def test_format_response_200_ok_empty(self):
         """Format 200 OK response with no records."""
         resp = format_p2s_response(STATUS_OK, [])
 
         expected = f"{PROTOCOL_VERSION} 200 OK{CRLF}{CRLF}{CRLF}"
-        assert resp == expected
+        assert resp == expected.encode("utf-8")
 
     def test_format_response_404_not_found(self):
         """Format 404 Not Found response."""
         resp = format_p2s_response(STATUS_NOT_FOUND, [])
 
-        assert f"{PROTOCOL_VERSION} 404 Not Found{CRLF}{CRLF}" in resp
+        assert f"{PROTOCOL_VERSION} 404 Not Found{CRLF}{CRLF}".encode("utf-8") in resp
 
     def test_format_response_400_bad_request(self):
         """Format 400 Bad Request response."""
         resp = format_p2s_response(STATUS_BAD_REQUEST, [])
 
-        assert f"{PROTOCOL_VERSION} 400 Bad Request{CRLF}{CRLF}" in resp
+        assert f"{PROTOCOL_VERSION} 400 Bad Request{CRLF}{CRLF}".encode("utf-8") in resp
 
     def test_format_response_505_version_not_supported(self):
         """Format 505 Version Not Supported response."""
         resp = format_p2s_response(STATUS_VERSION_NOT_SUPPORTED, [])
 
-        assert f"{PROTOCOL_VERSION} 505 P2P-CI Version Not Supported{CRLF}{CRLF}" in resp
+        assert f"{PROTOCOL_VERSION} 505 P2P-CI Version Not Supported{CRLF}{CRLF}".encode("utf-8") in resp
 
     def test_format_response_multiword_title(self):
         """Response with multi-word RFC title."""
         records = [(456, "A Proferred Official ICP Specification", "host.example.com", 5000)]
         resp = format_p2s_response(STATUS_OK, records)
 
-        assert "456 A Proferred Official ICP Specification host.example.com 5000" in resp
+        assert b"456 A Proferred Official ICP Specification host.example.com 5000" in resp
+
+    def test_format_response_parts_match_joined_response(self):
+        """Encoded pieces join to exactly the formatted response."""
+        records = [
+            (123, "Test RFC", "host1.example.com", 5001),
+            (456, "Another RFC", "host2.example.com", 5002),
+        ]
+        parts = format_p2s_response_parts(STATUS_OK, records)
+
+        assert len(parts) == 4
+        assert b"".join(parts) == format_p2s_response(STATUS_OK, records)
 
 
 # ============================================================================
@@ -437,11 +488,11 @@ class TestP2PRequestParsing:
         result = parse_p2p_request(req)
 
         assert result is not None
-        assert result["method"] == METHOD_GET
-        assert result["rfc_number"] == 1234
-        assert result["version"] == PROTOCOL_VERSION
-        assert result["host"] == "somehost.csc.ncsu.edu"
-        assert result["os"] == "Mac OS 10.4.1"
+        assert result.method == METHOD_GET
+        assert result.rfc_number == 1234
+        assert result.version == PROTOCOL_VERSION
+        assert result.host == "somehost.csc.ncsu.edu"
+        assert result.os == "Mac OS 10.4.1"
 
     def test_parse_get_request_missing_host(self):
         """P2P GET request missing Host header."""
@@ -480,6 +531,19 @@ class TestP2PRequestParsing:
 
         assert result is None
 
+    def test_parse_get_request_oversized_rfc_number(self):
+        """P2P GET request with an RFC number too long for int()."""
+        req = (
+            f"GET RFC {'9' * 5000} {PROTOCOL_VERSION}{CRLF}"
+            f"{HEADER_HOST}: host.example.com{CRLF}"
+            f"{HEADER_OS}: Linux{CRLF}"
+            f"{CRLF}"
+        ).encode("utf-8")
+
+        result = parse_p2p_request(req)
+
+        assert result is None
+
     def test_parse_get_request_wrong_keyword(self):
         """P2P request with wrong RFC keyword."""
         req = (
@@ -527,6 +591,17 @@ class TestP2PRequestParsing:
         # Should still parse successfully with error handling
         assert result is not None or result is None  # Either result is acceptable
 
+    def test_parse_get_request_header_order(self):
+        """Headers in either order parse to the same request."""
+        canonical = f"GET RFC 1234 {PROTOCOL_VERSION}{CRLF}{HEADER_HOST}: host{CRLF}{HEADER_OS}: Linux{CRLF}{CRLF}"
+        reordered = f"GET RFC 1234 {PROTOCOL_VERSION}{CRLF}{HEADER_OS}: Linux{CRLF}{HEADER_HOST}: host{CRLF}{CRLF}"
+
+        result = parse_p2p_request(canonical.encode("utf-8"))
+
+        assert result == parse_p2p_request(reordered.encode("utf-8"))
+        assert result.host == "host"
+        assert result.os == "Linux"
+
 
 # ============================================================================
 # P2P RESPONSE FORMATTING TESTS
@@ -607,6 +682,20 @@ class TestP2PResponseFormatting:
         resp_str = resp.decode("utf-8")
         assert f"{PROTOCOL_VERSION} 200 OK" in resp_str
 
+    def test_format_response_parts_keep_data_separate(self):
+        """Scatter form hands back the body object itself after the header."""
+        headers = {HEADER_CONTENT_LENGTH: "100"}
+        data = bytes(range(100))
+
+        parts = format_p2p_response_parts(STATUS_OK, headers, data)
+
+        assert len(parts) == 2
+        assert parts[1] is data
+        assert b"".join(parts) == format_p2p_response(STATUS_OK, headers, data)
+        assert format_p2p_response_parts(STATUS_NOT_FOUND, {HEADER_CONTENT_LENGTH: "0"}) == [
+            format_p2p_response(STATUS_NOT_FOUND, {HEADER_CONTENT_LENGTH: "0"}, b"")
+        ]
+
 
 # ============================================================================
 # ROUND-TRIP TESTS (Format then Parse)
@@ -623,11 +712,11 @@ class TestP2SRoundTrip:
         parsed = parse_p2s_request(original)
 
         assert parsed is not None
-        assert parsed["method"] == METHOD_ADD
-        assert parsed["rfc_number"] == 123
-        assert parsed["host"] == "host.example.com"
-        assert parsed["port"] == 5678
-        assert parsed["title"] == "Test RFC"
+        assert parsed.method == METHOD_ADD
+        assert parsed.rfc_number == 123
+        assert parsed.host == "host.example.com"
+        assert parsed.port == 5678
+        assert parsed.title == "Test RFC"
 
     def test_format_and_parse_response_with_records(self):
         """Format response then parse it back."""
@@ -636,7 +725,7 @@ class TestP2SRoundTrip:
             (456, "Another RFC", "host2.example.com", 5002),
         ]
         formatted = format_p2s_response(STATUS_OK, records)
-        status, parsed_records = parse_p2s_response(formatted)
+        status, parsed_records = parse_p2s_response(formatted.decode("utf-8"))
 
         assert status == 200
         assert len(parsed_records) == 2
@@ -665,16 +754,16 @@ class TestProtocolEdgeCases:
         result = parse_p2s_request(req)
 
         assert result is not None
-        assert result["host"] == "host.example.com"
-        assert result["port"] == 5678
-        assert result["title"] == "Test RFC"
+        assert result.host == "host.example.com"
+        assert result.port == 5678
+        assert result.title == "Test RFC"
 
     def test_format_response_many_records(self):
         """Format response with many RFC records."""
         records = [(i, f"RFC {i}", f"host{i}.example.com", 5000 + i) for i in range(1, 11)]
         resp = format_p2s_response(STATUS_OK, records)
 
-        status, parsed = parse_p2s_response(resp)
+        status, parsed = parse_p2s_response(resp.decode("utf-8"))
         assert status == 200
         assert len(parsed) == 10
 
@@ -704,7 +793,7 @@ class TestProtocolEdgeCases:
         result = parse_p2p_request(req)
 
         assert result is not None
-        assert "Linux kernel 5.15.0" in result["os"]
+        assert "Linux kernel 5.15.0" in result.os
 
     def test_large_rfc_number(self):
         """Test with large RFC number."""
@@ -712,7 +801,7 @@ class TestProtocolEdgeCases:
         parsed = parse_p2s_request(req)
 
         assert parsed is not None
-        assert parsed["rfc_number"] == 9999999
+        assert parsed.rfc_number == 9999999
 
     def test_large_port_number(self):
         """Test with large port number."""
@@ -720,4 +809,4 @@ class TestProtocolEdgeCases:
         parsed = parse_p2s_request(req)
 
         assert parsed is not None
-        assert parsed["port"] == 65535
+        assert parsed.port == 65535